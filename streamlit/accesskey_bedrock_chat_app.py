@@ -1,9 +1,15 @@
 import streamlit as st
-import boto3
-import json
-import uuid
+import orjson
+import secrets
 import os
-from botocore.exceptions import ClientError
+import hashlib
+import re
+import time
+import threading
+from collections import deque
+from itertools import islice
+from dataclasses import dataclass
+from typing import Callable
 
 # Set page configuration
 st.set_page_config(
@@ -12,12 +18,40 @@ st.set_page_config(
     layout="centered"
 )
 
+# Maximum number of chat messages kept in session state
+MAX_MESSAGES = 200
+
+# Number of newest messages rendered as full chat messages; older ones are
+# collapsed into a single pre-rendered markdown block
+RECENT_MESSAGES = 2
+
 # Initialize session state variables
+# Messages are held in a bounded buffer; message_total counts every message
+# ever added so positions stay stable as the oldest entries are dropped
 if "messages" not in st.session_state:
-    st.session_state.messages = []
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+    st.session_state.message_total = 0
 
 if "conversation_id" not in st.session_state:
-    st.session_state.conversation_id = str(uuid.uuid4())
+    st.session_state.conversation_id = secrets.token_hex(16)
+
+# Pre-rendered markdown for each settled message still in the buffer and how
+# many messages have settled
+if "history_parts" not in st.session_state:
+    st.session_state.history_parts = deque(maxlen=MAX_MESSAGES - RECENT_MESSAGES)
+    st.session_state.history_count = 0
+
+# Summary of turns that have fallen out of the history window
+if "summary" not in st.session_state:
+    st.session_state.summary = ""
+    st.session_state.summary_count = 0
+
+# Prompts queued for batch inference and submitted batch jobs, keyed by job ARN
+if "batch_queue" not in st.session_state:
+    st.session_state.batch_queue = []
+
+if "batch_jobs" not in st.session_state:
+    st.session_state.batch_jobs = {}
 
 # App title and description
 st.title("Amazon Bedrock Chat Interface - FS AWS CoE")
@@ -74,6 +108,15 @@ with st.sidebar:
     max_tokens = st.slider("Max Response Tokens", 100, 4096, 1024)
     temperature = st.slider("Temperature", 0.0, 1.0, 0.7, 0.1)
     
+    # Batch inference settings
+    batch_mode = st.checkbox(
+        "Batch mode",
+        help="Queue prompts and run them together as a Bedrock batch inference job instead of chatting interactively"
+    )
+    if batch_mode:
+        batch_s3_uri = st.text_input("Batch S3 URI", placeholder="s3://bucket/prefix")
+        batch_role_arn = st.text_input("Batch Service Role ARN")
+    
     st.markdown("---")
     st.markdown("### About")
     st.markdown("""
@@ -81,163 +124,420 @@ with st.sidebar:
     AWS's foundation model service for generative AI.
     """)
 
-# Initialize Bedrock client
+# Shared client configuration: larger connection pool, keep-alive and adaptive retries
+BEDROCK_CONFIG_OPTIONS = {
+    "retries": {"mode": "adaptive", "max_attempts": 5},
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "connect_timeout": 3,
+    "read_timeout": 120,
+    "user_agent_extra": "fs-coe-streamlit/1.0"
+}
+
+# Initialize AWS clients
+# The secret key is excluded from the cache key (leading underscore) and
+# represented by its SHA-256 digest instead. boto3 is imported here rather than
+# at the top so the page renders before it is loaded
 @st.cache_resource
-def get_bedrock_client(region_name, aws_access_key=None, aws_secret_key=None, aws_session_token=None):
-    if aws_access_key and aws_secret_key:
+def get_aws_client(service_name, region_name, aws_access_key=None, aws_secret_key_hash=None, aws_session_token=None, _aws_secret_key=None):
+    import boto3
+    from botocore.config import Config
+    
+    config = Config(**BEDROCK_CONFIG_OPTIONS)
+    if aws_access_key and _aws_secret_key:
         # Use provided credentials
-        if aws_session_token:
-            return boto3.client(
-                'bedrock-runtime', 
-                region_name=region_name,
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                aws_session_token=aws_session_token
-            )
-        else:
-            return boto3.client(
-                'bedrock-runtime', 
-                region_name=region_name,
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key
-            )
+        return boto3.client(
+            service_name, 
+            region_name=region_name,
+            aws_access_key_id=aws_access_key,
+            aws_secret_access_key=_aws_secret_key,
+            aws_session_token=aws_session_token,
+            config=config
+        )
     else:
         # Use default credentials from ~/.aws/credentials
-        return boto3.client('bedrock-runtime', region_name=region_name)
+        return boto3.client(service_name, region_name=region_name, config=config)
+
+# Limits on the chat history sent with each request
+MAX_HISTORY_TURNS = 20
+MAX_PROMPT_TOKENS = 6000
+SUMMARY_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+# Request builders and stream chunk parsers for each model family
+def build_anthropic_request(messages, max_tokens, temperature, summary=""):
+    # Chat history is already kept in Claude's {"role", "content"} schema,
+    # so the messages are sent as-is without per-call conversion
+    request_body = {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "messages": messages
+    }
+    if summary:
+        request_body["system"] = f"Summary of the earlier conversation: {summary}"
+    return request_body
+
+def parse_anthropic_chunk(chunk_body):
+    if chunk_body.get('type') == "content_block_delta":
+        return chunk_body['delta'].get('text', "")
+    return ""
+
+def parse_anthropic_output(output):
+    return "".join(block.get('text', "") for block in output.get('content', []))
+
+def build_llama_request(messages, max_tokens, temperature, summary=""):
+    # Llama models use a different format
+    prompt = "".join(
+        f"Human: {msg['content']}\n" if msg["role"] == "user" else f"Assistant: {msg['content']}\n"
+        for msg in messages
+    ) + "Assistant: "
+    if summary:
+        prompt = f"Summary of the earlier conversation: {summary}\n" + prompt
+    
+    return {
+        "prompt": prompt,
+        "max_gen_len": max_tokens,
+        "temperature": temperature
+    }
+
+def parse_llama_chunk(chunk_body):
+    return chunk_body.get('generation', "")
+
+def parse_llama_output(output):
+    return output.get('generation', "")
 
-# Function to check if a model is accessible
-def check_model_access(client, model_id):
+def build_titan_request(messages, max_tokens, temperature, summary=""):
+    # Default format for Titan and other models
+    prompt = "".join(
+        f"User: {msg['content']}\n" if msg["role"] == "user" else f"Assistant: {msg['content']}\n"
+        for msg in messages
+    ) + "Assistant: "
+    if summary:
+        prompt = f"Summary of the earlier conversation: {summary}\n" + prompt
+    
+    return {
+        "inputText": prompt,
+        "textGenerationConfig": {
+            "maxTokenCount": max_tokens,
+            "temperature": temperature,
+            "topP": 0.9
+        }
+    }
+
+def parse_titan_chunk(chunk_body):
+    return chunk_body.get('outputText', "")
+
+def parse_titan_output(output):
+    return "".join(result.get('outputText', "") for result in output.get('results', []))
+
+@dataclass(frozen=True, slots=True)
+class ModelAdapter:
+    family: str
+    build_body: Callable[[list, int, float, str], dict]
+    parse_body: Callable[[dict], str]
+    parse_output: Callable[[dict], str]
+
+ANTHROPIC_ADAPTER = ModelAdapter(family="anthropic", build_body=build_anthropic_request, parse_body=parse_anthropic_chunk, parse_output=parse_anthropic_output)
+LLAMA_ADAPTER = ModelAdapter(family="llama", build_body=build_llama_request, parse_body=parse_llama_chunk, parse_output=parse_llama_output)
+TITAN_ADAPTER = ModelAdapter(family="titan", build_body=build_titan_request, parse_body=parse_titan_chunk, parse_output=parse_titan_output)
+
+# Adapters keyed by model id prefix
+ADAPTERS = {
+    "anthropic.": ANTHROPIC_ADAPTER,
+    "meta.llama": LLAMA_ADAPTER,
+    "amazon.titan": TITAN_ADAPTER
+}
+
+def adapter_for(model_id):
+    # Titan's format is the default for any other model
+    return next((adapter for prefix, adapter in ADAPTERS.items() if model_id.startswith(prefix)), TITAN_ADAPTER)
+
+# How long model availability results are reused before probing again
+# (seconds); a failed probe is retried much sooner
+MODEL_AVAILABILITY_TTL = 3600
+MODEL_AVAILABILITY_RETRY_TTL = 30
+
+# Function to check which models are available on demand in the region
+# A single control-plane call lists the text models offered on demand, so no
+# model is invoked and no tokens are generated. This says nothing about whether
+# the account has been granted access to a model; a missing grant shows up as
+# an AccessDeniedException when the model is called
+def check_model_availability(bedrock, model_ids):
+    response = bedrock.list_foundation_models(byInferenceType='ON_DEMAND')
+    available = {
+        model['modelId'] for model in response['modelSummaries']
+        if 'TEXT' in model['outputModalities']
+    }
+    return {mid: mid in available for mid in model_ids}
+
+# Store for model availability results shared across sessions and reruns, keyed
+# on short fingerprints of the access key and secret key and the region
+@st.cache_resource
+def get_model_availability_store():
+    return {"lock": threading.Lock(), "results": {}, "probing": set()}
+
+# Background task that probes model availability and posts the results to the store
+# Entries hold their expiry time; a failed probe is stored as None
+def _probe_and_store(store, store_key, bedrock, model_ids):
     try:
-        # Try to invoke the model with a minimal request
-        if "anthropic" in model_id:
-            request_body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 10,
-                "temperature": 0.7,
-                "messages": [{"role": "user", "content": "Hello"}]
-            }
-        elif "meta.llama" in model_id:
-            request_body = {
-                "prompt": "Human: Hello\nAssistant: ",
-                "max_gen_len": 10,
-                "temperature": 0.7
-            }
-        else:
-            request_body = {
-                "inputText": "Hello",
-                "textGenerationConfig": {
-                    "maxTokenCount": 10,
-                    "temperature": 0.7,
-                    "topP": 0.9
-                }
-            }
-            
-        client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
+        results = check_model_availability(bedrock, model_ids)
+        ttl = MODEL_AVAILABILITY_TTL
+    except Exception:
+        results = None
+        ttl = MODEL_AVAILABILITY_RETRY_TTL
+    with store["lock"]:
+        store["results"][store_key] = (time.time() + ttl, results)
+        store["probing"].discard(store_key)
+
+# Function to add a message to the chat history
+def add_message(role, content):
+    st.session_state.messages.append({"role": role, "content": content})
+    st.session_state.message_total += 1
+
+# Function to estimate the tokens in a list of messages
+# Approximates tokens as 4 characters each
+def estimate_tokens(messages):
+    return sum(len(msg["content"]) // 4 for msg in messages)
+
+# Function to keep the most recent turns within the turn and token budgets
+def trim_history(messages, max_turns=MAX_HISTORY_TURNS, max_tokens=MAX_PROMPT_TOKENS):
+    window = list(islice(messages, max(0, len(messages) - max_turns), None))
+    total_tokens = estimate_tokens(window)
+    while len(window) > 1 and (total_tokens > max_tokens or window[0]["role"] != "user"):
+        total_tokens -= len(window.pop(0)["content"]) // 4
+    return window
+
+# Function to summarize turns that no longer fit in the history window
+# Folds every dropped message not yet covered into the summary using a cheap
+# model; summary_count is the absolute position (see message_total) the
+# summary covers up to
+def update_summary(client, messages, dropped_count):
+    first_index = st.session_state.message_total - len(messages)
+    dropped_index = first_index + dropped_count
+    if dropped_index <= st.session_state.summary_count:
+        return st.session_state.summary
+    
+    start = max(st.session_state.summary_count, first_index) - first_index
+    transcript = "".join(f"{msg['role']}: {msg['content']}\n" for msg in islice(messages, start, dropped_count))
+    if st.session_state.summary:
+        transcript = f"Previous summary: {st.session_state.summary}\n" + transcript
+    request_body = build_anthropic_request(
+        [{"role": "user", "content": f"Summarize this conversation in a short paragraph:\n{transcript}"}],
+        512,
+        0.0
+    )
+    try:
+        response = client.invoke_model(
+            modelId=SUMMARY_MODEL_ID,
+            body=orjson.dumps(request_body)
         )
-        return True
-    except ClientError as e:
-        if "AccessDeniedException" in str(e):
-            return False
-        else:
-            # If it's another type of error, we'll assume the model is accessible
-            # but there's another issue
-            return True
+        st.session_state.summary = orjson.loads(response['body'].read())['content'][0]['text']
+        st.session_state.summary_count = dropped_index
+    except ClientError:
+        # Keep the previous summary if the summary model is unavailable
+        pass
+    return st.session_state.summary
 
-# Function to send message to Bedrock and get response
-def send_message_to_bedrock(client, model_id, messages, max_tokens, temperature):
+# Function to select the history sent with a request and its summary
+# The window holds every message after the end of the summary while that fits
+# the turn and token budgets. On overflow it is trimmed to half the budgets and
+# the dropped messages are folded into the summary, so the next few turns fit
+# without another summary call
+def history_window(client, messages):
+    first_index = st.session_state.message_total - len(messages)
+    summary_end = max(st.session_state.summary_count, first_index) - first_index
+    window = list(islice(messages, summary_end, None))
+    while len(window) > 1 and window[0]["role"] != "user":
+        window.pop(0)
+    if len(window) <= MAX_HISTORY_TURNS and estimate_tokens(window) <= MAX_PROMPT_TOKENS:
+        return window, st.session_state.summary
+    
+    history = trim_history(messages, MAX_HISTORY_TURNS // 2, MAX_PROMPT_TOKENS // 2)
+    summary = update_summary(client, messages, len(messages) - len(history))
+    return history, summary
+
+# Function to send message to Bedrock and stream back the response
+def send_message_to_bedrock(client, adapter, model_id, messages, max_tokens, temperature):
     try:
+        # Bound the history sent with the request
+        history, summary = history_window(client, messages)
+        
         # Format the prompt based on the model
-        if "anthropic" in model_id:
-            # Claude models use a specific format
-            conversation = []
-            for msg in messages:
-                role = "user" if msg["role"] == "user" else "assistant"
-                conversation.append({"role": role, "content": msg["content"]})
-            
-            request_body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": max_tokens,
-                "temperature": temperature,
-                "messages": conversation
-            }
-        elif "meta.llama" in model_id:
-            # Llama models use a different format
-            prompt = ""
-            for msg in messages:
-                if msg["role"] == "user":
-                    prompt += f"Human: {msg['content']}\n"
-                else:
-                    prompt += f"Assistant: {msg['content']}\n"
-            prompt += "Assistant: "
-            
-            request_body = {
-                "prompt": prompt,
-                "max_gen_len": max_tokens,
-                "temperature": temperature
-            }
-        else:
-            # Default format for Titan and other models
-            prompt = ""
-            for msg in messages:
-                if msg["role"] == "user":
-                    prompt += f"User: {msg['content']}\n"
-                else:
-                    prompt += f"Assistant: {msg['content']}\n"
-            prompt += "Assistant: "
-            
-            request_body = {
-                "inputText": prompt,
-                "textGenerationConfig": {
-                    "maxTokenCount": max_tokens,
-                    "temperature": temperature,
-                    "topP": 0.9
-                }
-            }
+        request_body = adapter.build_body(history, max_tokens, temperature, summary)
         
-        # Invoke the model
-        response = client.invoke_model(
+        # Invoke the model and stream the response as it is generated
+        response = client.invoke_model_with_response_stream(
             modelId=model_id,
-            body=json.dumps(request_body)
+            body=orjson.dumps(request_body)
         )
         
-        # Parse the response based on the model
-        response_body = json.loads(response['body'].read().decode('utf-8'))
-        
-        if "anthropic" in model_id:
-            return response_body['content'][0]['text']
-        elif "meta.llama" in model_id:
-            return response_body['generation']
-        else:
-            return response_body['results'][0]['outputText']
+        # Parse each chunk based on the model
+        for event in response['body']:
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            text = adapter.parse_body(orjson.loads(chunk['bytes']))
+            if text:
+                yield text
             
     except ClientError as e:
-        st.error(f"Error sending message: {e}")
-        return "I encountered an error processing your request. Please check your AWS credentials and permissions."
+        if e.response.get('Error', {}).get('Code') == "AccessDeniedException":
+            st.error(f"Your account doesn't have access to {model_id}. Please enable access in the AWS Bedrock console or select a different model.")
+        else:
+            st.error(f"Error sending message: {e}")
+        yield "I encountered an error processing your request. Please check your AWS credentials and permissions."
+
+# Minimum number of records Bedrock accepts in a batch inference job (default quota)
+BATCH_MIN_RECORDS = 100
+
+# Matches s3://<bucket>[/<prefix>] with a valid bucket name
+BATCH_S3_URI_PATTERN = re.compile(r"s3://([a-z0-9][a-z0-9.-]{1,61}[a-z0-9])(?:/(.*))?")
+
+# Function to submit queued prompts as a Bedrock batch inference job
+# Returns the job ARN and the S3 bucket and prefix its results are written to
+def submit_batch_job(bedrock, s3, adapter, model_id, prompts, max_tokens, temperature, s3_uri, role_arn):
+    bucket, prefix = BATCH_S3_URI_PATTERN.fullmatch(s3_uri).groups()
+    prefix = prefix or ""
+    job_name = f"chat-batch-{int(time.time())}"
+    job_prefix = f"{prefix.strip('/')}/{job_name}".lstrip("/")
+    
+    # One JSON record per line; record ids keep results in prompt order
+    records = b"\n".join(
+        orjson.dumps({
+            "recordId": f"REC{i:08d}",
+            "modelInput": adapter.build_body([{"role": "user", "content": prompt}], max_tokens, temperature)
+        })
+        for i, prompt in enumerate(prompts)
+    )
+    s3.put_object(Bucket=bucket, Key=f"{job_prefix}/input.jsonl", Body=records)
+    
+    response = bedrock.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{job_prefix}/input.jsonl"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{job_prefix}/output/"}}
+    )
+    return response['jobArn'], bucket, f"{job_prefix}/output/"
+
+# Function to read the results of a completed batch job, keyed by record id
+# Records that failed carry an error instead of a model output
+def fetch_batch_results(s3, adapter, bucket, prefix):
+    results = {}
+    for obj in s3.list_objects_v2(Bucket=bucket, Prefix=prefix).get('Contents', []):
+        if not obj['Key'].endswith(".jsonl.out"):
+            continue
+        body = s3.get_object(Bucket=bucket, Key=obj['Key'])['Body'].read()
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            record = orjson.loads(line)
+            if "modelOutput" in record:
+                results[record['recordId']] = adapter.parse_output(record['modelOutput'])
+            else:
+                results[record['recordId']] = f"Error: {record.get('error', 'no output')}"
+    return results
 
 # Initialize Bedrock client
-bedrock_client = get_bedrock_client(
-    aws_region,
-    aws_access_key=aws_access_key if aws_access_key else None,
-    aws_secret_key=aws_secret_key if aws_secret_key else None,
-    aws_session_token=aws_session_token if aws_session_token else None
-)
+client_args = {
+    "aws_access_key": aws_access_key if aws_access_key else None,
+    "aws_secret_key_hash": hashlib.sha256(aws_secret_key.encode()).hexdigest() if aws_secret_key else None,
+    "aws_session_token": aws_session_token if aws_session_token else None,
+    "_aws_secret_key": aws_secret_key if aws_secret_key else None
+}
+bedrock_client = get_aws_client('bedrock-runtime', aws_region, **client_args)
+bedrock_control_client = get_aws_client('bedrock', aws_region, **client_args)
+
+# botocore is loaded by now; the exception type is only needed from here on
+from botocore.exceptions import ClientError
+
+# Select the request/response adapter for the chosen model
+# The adapter is only resolved again when the user picks a different model
+if st.session_state.get("model_family_id") != model_id:
+    st.session_state.model_family_id = model_id
+    st.session_state.model_adapter = adapter_for(model_id)
+model_adapter = st.session_state.model_adapter
+
+# Function to render a settled message as markdown
+# An unclosed code fence is closed so it can't swallow the messages after it
+def message_markdown(message):
+    content = message["content"]
+    if content.count("```") % 2:
+        content += "\n```"
+    return f"**{message['role'].title()}:**\n\n{content}"
 
 # Display chat messages
-for message in st.session_state.messages:
-    with st.chat_message(message["role"]):
-        st.write(message["content"])
+# Rendered as a fragment so the history is isolated from the input/append path
+@st.fragment
+def render_history():
+    messages = st.session_state.messages
+    # Absolute position of the oldest message still held in the buffer
+    first_index = st.session_state.message_total - len(messages)
+    
+    # Render newly settled messages; the parts buffer drops the oldest ones in
+    # step with the message buffer
+    settled = st.session_state.message_total - RECENT_MESSAGES
+    if settled > st.session_state.history_count:
+        start = max(st.session_state.history_count, first_index) - first_index
+        st.session_state.history_parts.extend(
+            message_markdown(message) for message in islice(messages, start, settled - first_index)
+        )
+        st.session_state.history_count = settled
+    
+    if st.session_state.history_parts:
+        st.markdown("\n\n---\n\n".join(st.session_state.history_parts))
+    
+    for message in islice(messages, max(0, st.session_state.history_count - first_index), None):
+        with st.chat_message(message["role"]):
+            st.write(message["content"])
 
-# Check model access when model is selected
-if "model_access_checked" not in st.session_state:
-    st.session_state.model_access_checked = {}
+render_history()
 
-if model_id not in st.session_state.model_access_checked and aws_access_key and aws_secret_key:
-    has_access = check_model_access(bedrock_client, model_id)
-    st.session_state.model_access_checked[model_id] = has_access
-    if not has_access:
-        st.warning(f"⚠️ You don't have access to {selected_model}. Please enable access in the AWS Bedrock console or select a different model.")
+# Check which models are available in the region once credentials are provided
+# The check runs in a background thread so it never blocks rendering; the
+# results are picked up on the next rerun
+is_available = True
+if aws_access_key and aws_secret_key:
+    availability_store = get_model_availability_store()
+    availability_store_key = (
+        hashlib.sha1(aws_access_key.encode()).hexdigest()[:12],
+        client_args["aws_secret_key_hash"][:12],
+        aws_region
+    )
+    with availability_store["lock"]:
+        availability_entry = availability_store["results"].get(availability_store_key)
+        st.session_state.probing = availability_entry is None or time.time() > availability_entry[0]
+        if st.session_state.probing and availability_store_key not in availability_store["probing"]:
+            availability_store["probing"].add(availability_store_key)
+            threading.Thread(
+                target=_probe_and_store,
+                args=(availability_store, availability_store_key, bedrock_control_client, tuple(model_options.values())),
+                daemon=True
+            ).start()
+    
+    # Unknown availability (not probed yet or the probe failed); models are
+    # treated as available
+    if availability_entry is not None and availability_entry[1] is not None:
+        st.session_state.model_availability = availability_entry[1]
+    else:
+        st.session_state.model_availability = {}
+    
+    if st.session_state.probing:
+        st.sidebar.info("Checking model availability…")
+    elif availability_entry[1] is None:
+        st.sidebar.warning("Could not check model availability. Check your AWS credentials and region.")
+    
+    with st.sidebar.expander("Models available in this region"):
+        for name, mid in model_options.items():
+            if mid not in st.session_state.model_availability:
+                status = "⏳" if st.session_state.probing else "❔"
+            else:
+                status = "✅" if st.session_state.model_availability[mid] else "❌"
+            st.markdown(f"{status} {name}")
+    
+    is_available = st.session_state.model_availability.get(model_id, True)
+    if not is_available:
+        st.warning(f"⚠️ {selected_model} is not available on demand in {aws_region}. Please select a different model or region.")
 
 # Chat input
 if prompt := st.chat_input("Ask a question..."):
@@ -245,41 +545,115 @@ if prompt := st.chat_input("Ask a question..."):
     if not aws_access_key or not aws_secret_key:
         st.error("Please provide your AWS credentials in the sidebar to use this app.")
     else:
-        # Check model access
-        has_access = st.session_state.model_access_checked.get(model_id, False)
-        if not has_access and model_id in st.session_state.model_access_checked:
-            st.error(f"You don't have access to {selected_model}. Please enable access in the AWS Bedrock console or select a different model.")
+        # Check model availability
+        if not is_available:
+            st.error(f"{selected_model} is not available on demand in {aws_region}. Please select a different model or region.")
+        elif batch_mode:
+            # Queue the prompt for the next batch job
+            st.session_state.batch_queue.append(prompt)
+            st.info(f"Queued for batch inference ({len(st.session_state.batch_queue)} pending)")
         else:
             # Add user message to chat history
-            st.session_state.messages.append({"role": "user", "content": prompt})
+            add_message("user", prompt)
             
             # Display user message
             with st.chat_message("user"):
                 st.write(prompt)
             
-            # Get response from Bedrock
+            # Stream response from Bedrock as tokens arrive
             with st.chat_message("assistant"):
-                with st.spinner(f"{selected_model} is thinking..."):
-                    response = send_message_to_bedrock(
+                response = st.write_stream(
+                    send_message_to_bedrock(
                         bedrock_client,
+                        model_adapter,
                         model_id,
                         st.session_state.messages,
                         max_tokens,
                         temperature
                     )
+                )
             
             if response:
-                st.write(response)
-                
                 # Add assistant response to chat history
-                st.session_state.messages.append({"role": "assistant", "content": response})
+                add_message("assistant", response)
             else:
                 st.error("Failed to get response from the model")
 
+# Batch inference queue and job status
+if batch_mode:
+    st.subheader("Batch Inference")
+    
+    if st.session_state.batch_queue:
+        queued = len(st.session_state.batch_queue)
+        st.markdown("\n".join(f"{i}. {q}" for i, q in enumerate(st.session_state.batch_queue, 1)))
+        if queued < BATCH_MIN_RECORDS:
+            st.caption(f"Bedrock batch jobs need at least {BATCH_MIN_RECORDS} prompts; {BATCH_MIN_RECORDS - queued} more to queue.")
+        if st.button("Submit Batch Job", disabled=queued < BATCH_MIN_RECORDS):
+            if not batch_s3_uri or not batch_role_arn:
+                st.error("Please provide the batch S3 URI and service role ARN in the sidebar.")
+            elif not BATCH_S3_URI_PATTERN.fullmatch(batch_s3_uri):
+                st.error("The batch S3 URI must look like s3://bucket or s3://bucket/prefix.")
+            else:
+                try:
+                    job_arn, bucket, output_prefix = submit_batch_job(
+                        bedrock_control_client,
+                        get_aws_client('s3', aws_region, **client_args),
+                        model_adapter,
+                        model_id,
+                        st.session_state.batch_queue,
+                        max_tokens,
+                        temperature,
+                        batch_s3_uri,
+                        batch_role_arn
+                    )
+                    st.session_state.batch_jobs[job_arn] = {
+                        "status": "Submitted",
+                        "model_id": model_id,
+                        "prompts": list(st.session_state.batch_queue),
+                        "bucket": bucket,
+                        "output_prefix": output_prefix,
+                        "results": None
+                    }
+                    st.session_state.batch_queue = []
+                    st.success(f"Submitted batch job {job_arn}")
+                except ClientError as e:
+                    st.error(f"Error submitting batch job: {e}")
+    else:
+        st.info("No prompts queued. Prompts entered in batch mode are queued here.")
+    
+    if st.session_state.batch_jobs:
+        # Poll job status on demand rather than on every rerun
+        # Results are read back once, when a job is first seen completed
+        if st.button("Refresh Batch Status"):
+            for job_arn, job in st.session_state.batch_jobs.items():
+                try:
+                    job['status'] = bedrock_control_client.get_model_invocation_job(jobIdentifier=job_arn)['status']
+                    if job['status'] == "Completed" and job['results'] is None:
+                        job['results'] = fetch_batch_results(
+                            get_aws_client('s3', aws_region, **client_args),
+                            adapter_for(job['model_id']),
+                            job['bucket'],
+                            job['output_prefix']
+                        )
+                except ClientError as e:
+                    st.error(f"Error checking batch job: {e}")
+        for job_arn, job in st.session_state.batch_jobs.items():
+            st.write(f"{job_arn}: {job['status']}")
+            if job['results'] is not None:
+                with st.expander(f"Results ({len(job['results'])} of {len(job['prompts'])} prompts)"):
+                    for i, prompt in enumerate(job['prompts']):
+                        st.markdown(f"**{prompt}**")
+                        st.markdown(job['results'].get(f"REC{i:08d}", "_No result for this prompt._"))
+
 # Reset conversation button
 if st.button("Start New Conversation"):
-    st.session_state.conversation_id = str(uuid.uuid4())
-    st.session_state.messages = []
+    st.session_state.conversation_id = secrets.token_hex(16)
+    st.session_state.messages = deque(maxlen=MAX_MESSAGES)
+    st.session_state.message_total = 0
+    st.session_state.history_parts = deque(maxlen=MAX_MESSAGES - RECENT_MESSAGES)
+    st.session_state.history_count = 0
+    st.session_state.summary = ""
+    st.session_state.summary_count = 0
     st.rerun()
 
 # Add a note about AWS credentials
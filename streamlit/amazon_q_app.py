@@ -1,7 +1,5 @@
 import streamlit as st
-import boto3
 import json
-from botocore.exceptions import ClientError
 
 # Set page configuration
 st.set_page_config(
@@ -34,19 +32,34 @@ with st.sidebar:
     AWS's generative AI-powered assistant.
     """)
 
+# Shared client configuration: larger connection pool, keep-alive and adaptive retries
+CLIENT_CONFIG_OPTIONS = {
+    "retries": {"mode": "adaptive", "max_attempts": 5},
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "connect_timeout": 3,
+    "read_timeout": 120,
+    "user_agent_extra": "fs-coe-streamlit/1.0"
+}
+
 # Initialize Amazon Q client
+# boto3 is imported here rather than at the top so the page renders before it is loaded
 @st.cache_resource
 def get_q_client(region_name):
-    return boto3.client('qconnect', region_name=region_name)
+    import boto3
+    from botocore.config import Config
+    
+    return boto3.client('qconnect', region_name=region_name, config=Config(**CLIENT_CONFIG_OPTIONS))
 
 # Function to start a new conversation
-def start_conversation(client, app_id):
+# The session id is kept in session state, so a session is only created when
+# there is none yet
+def start_conversation(client, app_id, region_name):
     try:
-        # Create a session with Amazon Q Connect
         response = client.create_session(
             assistantId=app_id
         )
-        return response.get('sessionId')
+        return response.get('session', {}).get('sessionId')
     except ClientError as e:
         st.error(f"Error starting conversation: {e}")
         return None
@@ -63,12 +76,15 @@ def send_message_to_q(client, session_id, message):
         st.error(f"Error sending message: {e}")
         return None
 
-# Initialize Q client
-q_client = get_q_client(aws_region)
+# Initialize Q client once an application is configured
+q_client = get_q_client(aws_region) if application_id else None
+
+# botocore is loaded by now; the exception type is only needed from here on
+from botocore.exceptions import ClientError
 
 # Start a new conversation if needed
 if st.session_state.conversation_id is None and application_id:
-    st.session_state.conversation_id = start_conversation(q_client, application_id)
+    st.session_state.conversation_id = start_conversation(q_client, application_id, aws_region)
 
 # Display chat messages
 for message in st.session_state.messages:
@@ -107,6 +123,6 @@ if prompt := st.chat_input("Ask Amazon Q..."):
 
 # Reset conversation button
 if st.button("Start New Conversation") and application_id:
-    st.session_state.conversation_id = start_conversation(q_client, application_id)
+    st.session_state.conversation_id = start_conversation(q_client, application_id, aws_region)
     st.session_state.messages = []
     st.rerun()
@@ -1,10 +1,20 @@
 import streamlit as st
 import boto3
-import json
+import orjson
 import uuid
 import os
 import time
+import hashlib
+import re
+import secrets
+import sqlite3
+import zlib
+import threading
 import pandas as pd
+from collections import OrderedDict, deque
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
 # Set page configuration
@@ -14,18 +24,104 @@ st.set_page_config(
     layout="centered"
 )
 
-# Initialize session state variables
-if "messages" not in st.session_state:
-    st.session_state.messages = []
+# Number of most recent messages sent to the model as context, number kept in
+# session state for rendering, and ring buffer size for trace logs /
+# performance metrics
+MAX_MESSAGES = 200
+HISTORY_WINDOW = 20
+DEFAULT_LOG_BUFFER_SIZE = 200
+
+# SQLite database holding the full history of every conversation
+HISTORY_DB_PATH = os.environ.get("CHAT_HISTORY_DB", "chat.db")
+
+# Models and regions that support latency-optimized inference
+LATENCY_OPTIMIZED_MODELS = {
+    "us.anthropic.claude-3-5-haiku-20241022-v1:0",
+    "us.meta.llama3-1-70b-instruct-v1:0",
+    "us.meta.llama3-1-405b-instruct-v1:0",
+    "us.amazon.nova-pro-v1:0"
+}
+LATENCY_OPTIMIZED_REGIONS = {"us-east-2", "us-west-2"}
+
+# Shared connection to the history database, kept across reruns and sessions
+# Writes from different sessions are serialized through the lock
+@st.cache_resource
+def get_history_db():
+    conn = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False)
+    conn.execute("CREATE TABLE IF NOT EXISTS messages (conv_id TEXT, idx INT, role TEXT, content TEXT)")
+    conn.execute("CREATE INDEX IF NOT EXISTS messages_conv_idx ON messages (conv_id, idx)")
+    conn.commit()
+    return {"lock": threading.Lock(), "conn": conn}
+
+# Function to load the last `limit` messages of a conversation, oldest first
+def load_messages(conv_id, limit):
+    db = get_history_db()
+    with db["lock"]:
+        rows = db["conn"].execute(
+            "SELECT role, content FROM messages WHERE conv_id = ? ORDER BY idx DESC LIMIT ?",
+            (conv_id, limit)
+        ).fetchall()
+    return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+# Function to check whether a conversation has any stored messages
+def conversation_exists(conv_id):
+    db = get_history_db()
+    with db["lock"]:
+        return db["conn"].execute("SELECT 1 FROM messages WHERE conv_id = ? LIMIT 1", (conv_id,)).fetchone() is not None
 
+# Function to add messages to the conversation in one transaction
+# The messages are persisted and appended to the in-memory rendering window;
+# each index is assigned by the database so sessions sharing a conversation
+# never write the same one
+def add_messages(*messages):
+    db = get_history_db()
+    with db["lock"], db["conn"]:
+        for msg in messages:
+            db["conn"].execute(
+                "INSERT INTO messages (conv_id, idx, role, content) "
+                "SELECT ?, COALESCE(MAX(idx) + 1, 0), ?, ? FROM messages WHERE conv_id = ?",
+                (st.session_state.conversation_id, msg["role"], msg["content"], st.session_state.conversation_id)
+            )
+    st.session_state.messages.extend(messages)
+
+# Function to generate an unguessable conversation id
+def new_conversation_id():
+    return secrets.token_urlsafe(16)
+
+# Matches the ids generated by new_conversation_id
+CONVERSATION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{22}")
+
+# Initialize session state variables
+# The conversation id is kept in the URL so a page reload resumes the
+# conversation; only well-formed ids of stored conversations are accepted
 if "conversation_id" not in st.session_state:
-    st.session_state.conversation_id = str(uuid.uuid4())
+    conv_id = st.query_params.get("conv", "")
+    if not (CONVERSATION_ID_PATTERN.fullmatch(conv_id) and conversation_exists(conv_id)):
+        conv_id = new_conversation_id()
+    st.session_state.conversation_id = conv_id
+    st.query_params["conv"] = conv_id
+
+if "messages" not in st.session_state:
+    st.session_state.messages = deque(
+        load_messages(st.session_state.conversation_id, HISTORY_WINDOW),
+        maxlen=HISTORY_WINDOW
+    )
 
 if "trace_logs" not in st.session_state:
-    st.session_state.trace_logs = []
+    st.session_state.trace_logs = deque(maxlen=DEFAULT_LOG_BUFFER_SIZE)
 
 if "performance_metrics" not in st.session_state:
-    st.session_state.performance_metrics = []
+    st.session_state.performance_metrics = deque(maxlen=DEFAULT_LOG_BUFFER_SIZE)
+
+# Questions queued to be answered together in a single request
+if "pending_queries" not in st.session_state:
+    st.session_state.pending_queries = []
+
+# Identifies this session's metrics in the shared DataFrame cache; the version
+# is bumped whenever the metrics change
+if "metrics_version" not in st.session_state:
+    st.session_state.metrics_key = str(uuid.uuid4())
+    st.session_state.metrics_version = 0
 
 # App title and description
 st.title("Amazon Bedrock Chat Interface - FS AWS CoE")
@@ -49,6 +145,7 @@ with st.sidebar:
         "Claude Instant": "anthropic.claude-instant-v1",
         "Claude 3 Haiku": "anthropic.claude-3-haiku-20240307-v1:0",
         "Claude 3 Sonnet": "anthropic.claude-3-sonnet-20240229-v1:0",
+        "Claude 3.5 Haiku": "us.anthropic.claude-3-5-haiku-20241022-v1:0",
         "Llama 2 Chat 13B": "meta.llama2-13b-chat-v1"
     }
     
@@ -81,6 +178,23 @@ with st.sidebar:
     max_tokens = st.slider("Max Response Tokens", 100, 4096, 1024)
     temperature = st.slider("Temperature", 0.0, 1.0, 0.7, 0.1)
     
+    latency_optimized = st.checkbox(
+        "Latency-optimized",
+        help="Use Bedrock latency-optimized inference for supported models and regions"
+    )
+    if latency_optimized and not (model_id in LATENCY_OPTIMIZED_MODELS and aws_region in LATENCY_OPTIMIZED_REGIONS):
+        st.caption("Latency-optimized inference is not available for this model/region; standard inference is used.")
+    
+    queue_mode = st.checkbox(
+        "Queue mode",
+        help="Queue questions and ask them together in a single request"
+    )
+    
+    log_buffer_size = st.slider(
+        "Trace/Metrics Buffer Size", 50, 1000, DEFAULT_LOG_BUFFER_SIZE, 50,
+        help="Number of most recent trace logs and performance metrics to keep"
+    )
+    
     st.markdown("---")
     st.markdown("### About")
     st.markdown("""
@@ -88,60 +202,61 @@ with st.sidebar:
     AWS's foundation model service for generative AI.
     """)
 
+# Resize the trace and metrics buffers when the buffer size changes
+if st.session_state.trace_logs.maxlen != log_buffer_size:
+    st.session_state.trace_logs = deque(st.session_state.trace_logs, maxlen=log_buffer_size)
+    st.session_state.performance_metrics = deque(st.session_state.performance_metrics, maxlen=log_buffer_size)
+    st.session_state.metrics_version += 1
+
+# Shared client configuration: keep-alive, larger connection pool and adaptive retries
+BEDROCK_CONFIG = Config(
+    retries={"mode": "adaptive", "max_attempts": 8},
+    max_pool_connections=50,
+    tcp_keepalive=True,
+    connect_timeout=3,
+    read_timeout=120,
+    user_agent_extra="fs-coe-chat"
+)
+
+# Function to compute a short fingerprint of the credentials
+# Used as a cache key in place of the raw secrets; without credentials every
+# session gets the same fingerprint and shares one client per region
+def credential_fingerprint(aws_access_key=None, aws_secret_key=None, aws_session_token=None):
+    material = "|".join((aws_access_key or "", aws_secret_key or "", aws_session_token or ""))
+    return hashlib.blake2b(material.encode(), digest_size=8).hexdigest()
+
 # Initialize Bedrock client
+# Cached on the region and the credential fingerprint; the credentials
+# themselves are passed as underscore arguments so they are not hashed
 @st.cache_resource
-def get_bedrock_client(region_name, aws_access_key=None, aws_secret_key=None, aws_session_token=None):
-    if aws_access_key and aws_secret_key:
+def get_bedrock_client(region_name, cred_fingerprint, _aws_access_key=None, _aws_secret_key=None, _aws_session_token=None):
+    if _aws_access_key and _aws_secret_key:
         # Use provided credentials
-        if aws_session_token:
-            return boto3.client(
-                'bedrock-runtime', 
-                region_name=region_name,
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                aws_session_token=aws_session_token
-            )
-        else:
-            return boto3.client(
-                'bedrock-runtime', 
-                region_name=region_name,
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key
-            )
+        return boto3.client(
+            'bedrock-runtime', 
+            region_name=region_name,
+            aws_access_key_id=_aws_access_key,
+            aws_secret_access_key=_aws_secret_key,
+            aws_session_token=_aws_session_token,
+            config=BEDROCK_CONFIG
+        )
     else:
         # Use default credentials from ~/.aws/credentials
-        return boto3.client('bedrock-runtime', region_name=region_name)
+        return boto3.client('bedrock-runtime', region_name=region_name, config=BEDROCK_CONFIG)
+
+# Shared worker pool for the concurrent model access checks, kept across reruns
+@st.cache_resource
+def get_executor():
+    return ThreadPoolExecutor(max_workers=4)
 
 # Function to check if a model is accessible
 def check_model_access(client, model_id):
     try:
         # Try to invoke the model with a minimal request
-        if "anthropic" in model_id:
-            request_body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": 10,
-                "temperature": 0.7,
-                "messages": [{"role": "user", "content": "Hello"}]
-            }
-        elif "meta.llama" in model_id:
-            request_body = {
-                "prompt": "Human: Hello\nAssistant: ",
-                "max_gen_len": 10,
-                "temperature": 0.7
-            }
-        else:
-            request_body = {
-                "inputText": "Hello",
-                "textGenerationConfig": {
-                    "maxTokenCount": 10,
-                    "temperature": 0.7,
-                    "topP": 0.9
-                }
-            }
-            
-        client.invoke_model(
+        client.converse(
             modelId=model_id,
-            body=json.dumps(request_body)
+            messages=[{"role": "user", "content": [{"text": "Hello"}]}],
+            inferenceConfig={"maxTokens": 10, "temperature": 0.7}
         )
         return True
     except ClientError as e:
@@ -152,119 +267,243 @@ def check_model_access(client, model_id):
             # but there's another issue
             return True
 
+# Function to check access to all models concurrently on the worker pool
+# Results are cached across reruns for an hour, keyed on the region, the models
+# and a short fingerprint of the credentials (the client itself is not hashed)
+@st.cache_data(ttl=3600, show_spinner=False)
+def check_all_model_access(_client, region_name, model_ids, cred_fingerprint):
+    results = get_executor().map(lambda mid: check_model_access(_client, mid), model_ids)
+    return dict(zip(model_ids, results))
+
+# Size and lifetime (seconds) of the process-wide response cache
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_TTL = 60
+
+# Process-wide LRU cache of recent responses, shared across sessions and reruns
+@st.cache_resource
+def get_response_cache():
+    return {"lock": threading.Lock(), "entries": OrderedDict()}
+
+# Function to build the response cache key for a request
+# The cache is shared across sessions, so the key includes the region and the
+# credential fingerprint to only serve responses generated under the same account
+def response_cache_key(region_name, cred_fingerprint, model_id, messages, max_tokens, temperature):
+    messages_hash = hashlib.blake2b(orjson.dumps(list(messages), option=orjson.OPT_SORT_KEYS)).hexdigest()
+    return (region_name, cred_fingerprint, model_id, max_tokens, temperature, messages_hash)
+
+# Function to look up a cached (response_text, input_tokens, output_tokens)
+def get_cached_response(key):
+    cache = get_response_cache()
+    with cache["lock"]:
+        entry = cache["entries"].get(key)
+        if entry is None:
+            return None
+        value, insert_ts = entry
+        if time.time() - insert_ts >= RESPONSE_CACHE_TTL:
+            del cache["entries"][key]
+            return None
+        cache["entries"].move_to_end(key)
+        return value
+
+# Function to store a response in the cache, evicting the least recently used
+def store_cached_response(key, value):
+    cache = get_response_cache()
+    with cache["lock"]:
+        cache["entries"][key] = (value, time.time())
+        cache["entries"].move_to_end(key)
+        while len(cache["entries"]) > RESPONSE_CACHE_SIZE:
+            cache["entries"].popitem(last=False)
+
+# Functions to store trace payloads compressed and pretty-print them when viewed
+def compress_payload(payload):
+    return zlib.compress(orjson.dumps(payload), 3)
+
+def decompress_payload(blob):
+    return orjson.dumps(orjson.loads(zlib.decompress(blob)), option=orjson.OPT_INDENT_2).decode()
+
+# Size and lifetime (seconds) of the metrics DataFrame cache
+METRICS_CACHE_SIZE = 64
+METRICS_CACHE_TTL = 3600
+
+# Function to record a performance metric
+def add_performance_metric(metric):
+    st.session_state.performance_metrics.append(metric)
+    st.session_state.metrics_version += 1
+
+# Function to build the metrics DataFrame, its column means, the newest-first
+# table and the long-format token usage used by the visualizations
+# Cached on the session's metrics key and version, so reruns that don't change
+# the metrics skip the rebuild; the metrics themselves are not hashed. Every new
+# version adds an entry, so the cache is bounded and entries expire
+@st.cache_data(show_spinner=False, max_entries=METRICS_CACHE_SIZE, ttl=METRICS_CACHE_TTL)
+def metrics_dataframe(metrics_key, metrics_version, _metrics):
+    df = pd.DataFrame(list(_metrics))
+    means = df[["response_time", "total_tokens", "tokens_per_second"]].mean()
+    display_df = df.sort_values(by='timestamp', ascending=False)
+    token_df = df.melt(
+        id_vars=["model", "timestamp"],
+        value_vars=["input_tokens", "output_tokens"],
+        var_name="Token Type",
+        value_name="Token Count"
+    )
+    return df, means, display_df, token_df
+
+# Background colour of each model family in the metrics table
+MODEL_COLORS = {
+    "Claude": "#e6f3ff",
+    "Titan": "#fff2e6",
+    "Llama": "#e6ffe6"
+}
+MODEL_COLOR_PATTERN = "(" + "|".join(MODEL_COLORS) + ")"
+
+# Function to colour-code a column of model names in one vectorized pass
+def highlight_models(models):
+    colors = models.str.extract(MODEL_COLOR_PATTERN, expand=False).map(MODEL_COLORS)
+    return ("background-color: " + colors).fillna("")
+
+# Matches the "[N]" marker line that starts each answer in a batch response
+BATCH_ANSWER_MARKER = re.compile(r"^[ \t]*\**\[(\d+)\]\**[ \t]*", re.MULTILINE)
+
+# Function to build a single prompt asking several numbered questions
+def build_batch_prompt(queries):
+    numbered = "\n".join(f"[{i}] {query}" for i, query in enumerate(queries, 1))
+    return f"Answer each numbered question. Start each answer on a new line with the question's number in brackets, e.g. \"[1] \".\n{numbered}"
+
+# Function to split a batch response into answers by question number
+# Markers are only taken in order from 1 to `count`, so numbers repeated
+# inside an answer never move text to another question
+def parse_batch_response(response_text, count):
+    answers = {}
+    expected = 1
+    start = None
+    for match in BATCH_ANSWER_MARKER.finditer(response_text):
+        if expected > count or int(match.group(1)) != expected:
+            continue
+        if start is not None:
+            answers[expected - 1] = response_text[start:match.start()].strip()
+        start = match.end()
+        expected += 1
+    if start is not None:
+        answers[expected - 1] = response_text[start:].strip()
+    return answers
+
 # Function to extract token counts from response
-def extract_token_counts(model_id, response_body):
-    input_tokens = 0
-    output_tokens = 0
-    
-    try:
-        if "anthropic" in model_id and "usage" in response_body:
-            usage = response_body['usage']
-            input_tokens = usage.get('input_tokens', 0)
-            output_tokens = usage.get('output_tokens', 0)
-        elif "amazon" in model_id and "amazon-bedrock-invocationMetrics" in response_body:
-            metrics = response_body['amazon-bedrock-invocationMetrics']
-            input_tokens = metrics.get('inputTokenCount', 0)
-            output_tokens = metrics.get('outputTokenCount', 0)
-        elif "meta.llama" in model_id:
-            # Llama models don't always return token counts
-            # Estimate based on text length (rough approximation)
-            prompt_length = len(str(response_body.get('prompt', '')))
-            generation_length = len(str(response_body.get('generation', '')))
-            input_tokens = prompt_length // 4  # Very rough approximation
-            output_tokens = generation_length // 4  # Very rough approximation
-    except Exception:
-        pass
-        
-    return input_tokens, output_tokens
+# The Converse API reports usage in the same shape for every model
+def extract_token_counts(response_body):
+    usage = response_body.get('usage') or {}
+    return usage.get('inputTokens', 0), usage.get('outputTokens', 0)
+
+# Function to make a history window valid to send: it must start on a user turn
+# and alternate roles, so leading assistant turns are dropped and a turn left
+# without a reply is replaced by the one that follows it
+def trim_history(messages):
+    window = []
+    for msg in messages:
+        if window and window[-1]["role"] == msg["role"]:
+            window[-1] = msg
+        elif window or msg["role"] == "user":
+            window.append(msg)
+    return window
 
-# Function to send message to Bedrock and get response
-def send_message_to_bedrock(client, model_id, messages, max_tokens, temperature):
+# Reply shown in place of a response when the request fails
+ERROR_RESPONSE = "I encountered an error processing your request. Please check your AWS credentials and permissions."
+
+# Function to send message to Bedrock and stream back the response
+# Sets st.session_state.request_failed when the request fails, including part
+# way through the stream, so callers don't have to inspect the streamed text
+def send_message_to_bedrock(client, model_id, messages, max_tokens, temperature, latency_optimized=False):
+    # One timestamp for the trace log and performance metric of this request
+    timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+    model_name = selected_model
+    messages = trim_history(messages)
+    st.session_state.request_failed = False
+    
     try:
-        # Format the prompt based on the model
-        if "anthropic" in model_id:
-            # Claude models use a specific format
-            conversation = []
-            for msg in messages:
-                role = "user" if msg["role"] == "user" else "assistant"
-                conversation.append({"role": role, "content": msg["content"]})
-            
-            request_body = {
-                "anthropic_version": "bedrock-2023-05-31",
-                "max_tokens": max_tokens,
+        # The Converse API takes the same message format for every model
+        request_body = {
+            "modelId": model_id,
+            "messages": [{"role": msg["role"], "content": [{"text": msg["content"]}]} for msg in messages],
+            "inferenceConfig": {
+                "maxTokens": max_tokens,
                 "temperature": temperature,
-                "messages": conversation
-            }
-        elif "meta.llama" in model_id:
-            # Llama models use a different format
-            prompt = ""
-            for msg in messages:
-                if msg["role"] == "user":
-                    prompt += f"Human: {msg['content']}\n"
-                else:
-                    prompt += f"Assistant: {msg['content']}\n"
-            prompt += "Assistant: "
-            
-            request_body = {
-                "prompt": prompt,
-                "max_gen_len": max_tokens,
-                "temperature": temperature
-            }
-        else:
-            # Default format for Titan and other models
-            prompt = ""
-            for msg in messages:
-                if msg["role"] == "user":
-                    prompt += f"User: {msg['content']}\n"
-                else:
-                    prompt += f"Assistant: {msg['content']}\n"
-            prompt += "Assistant: "
-            
-            request_body = {
-                "inputText": prompt,
-                "textGenerationConfig": {
-                    "maxTokenCount": max_tokens,
-                    "temperature": temperature,
-                    "topP": 0.9
-                }
+                "topP": 0.9
             }
+        }
+        if latency_optimized:
+            request_body["performanceConfig"] = {"latency": "optimized"}
         
         # Get the user's query (last message)
         user_query = messages[-1]["content"] if messages else ""
         
+        # Serve repeated identical requests from the response cache
+        cache_key = response_cache_key(aws_region, cred_fingerprint, model_id, messages, max_tokens, temperature)
+        cached = get_cached_response(cache_key)
+        if cached is not None:
+            response_text, input_tokens, output_tokens = cached
+            yield response_text
+            
+            st.session_state.trace_logs.append({
+                "timestamp": timestamp,
+                "model_id": model_id,
+                "request_z": compress_payload(request_body),
+                "response_z": compress_payload({"outputText": response_text}),
+                "input_tokens": input_tokens,
+                "output_tokens": output_tokens,
+                "elapsed_time": 0,
+                "cache_hit": True,
+                "parameters": {
+                    "max_tokens": max_tokens,
+                    "temperature": temperature
+                }
+            })
+            # Cache hits are traced but not recorded as performance metrics,
+            # which only reflect real Bedrock calls
+            return
+        
         # Record start time for tracing
         start_time = time.time()
+        first_token_time = None
         
-        # Invoke the model
-        response = client.invoke_model(
-            modelId=model_id,
-            body=json.dumps(request_body)
-        )
+        # Invoke the model and stream the response as it is generated
+        response = client.converse_stream(**request_body)
+        
+        # Collect the text deltas; the metadata event at the end of the stream
+        # carries token usage
+        response_parts = []
+        usage = None
+        for event in response['stream']:
+            if 'metadata' in event:
+                usage = event['metadata'].get('usage')
+            text = event['contentBlockDelta']['delta'].get('text', "") if 'contentBlockDelta' in event else ""
+            if text:
+                if first_token_time is None:
+                    first_token_time = time.time() - start_time
+                response_parts.append(text)
+                yield text
         
         # Calculate elapsed time
         elapsed_time = time.time() - start_time
         
-        # Parse the response based on the model
-        response_body = json.loads(response['body'].read().decode('utf-8'))
+        response_text = "".join(response_parts)
+        response_body = {
+            "outputText": response_text,
+            "usage": usage or {}
+        }
         
         # Extract token counts
-        input_tokens, output_tokens = extract_token_counts(model_id, response_body)
-        
-        # Get response text based on the model
-        if "anthropic" in model_id:
-            response_text = response_body['content'][0]['text']
-        elif "meta.llama" in model_id:
-            response_text = response_body['generation']
-        else:
-            response_text = response_body['results'][0]['outputText']
+        input_tokens, output_tokens = extract_token_counts(response_body)
+        store_cached_response(cache_key, (response_text, input_tokens, output_tokens))
         
         # Create trace log
         trace_log = {
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": timestamp,
             "model_id": model_id,
-            "request": request_body,
-            "response": response_body,
+            "request_z": compress_payload(request_body),
+            "response_z": compress_payload(response_body),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
             "elapsed_time": round(elapsed_time, 2),
+            "first_token_time": round(first_token_time, 2) if first_token_time is not None else None,
             "parameters": {
                 "max_tokens": max_tokens,
                 "temperature": temperature
@@ -276,97 +515,153 @@ def send_message_to_bedrock(client, model_id, messages, max_tokens, temperature)
         
         # Add to performance metrics
         performance_metric = {
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-            "model": selected_model,
+            "timestamp": timestamp,
+            "model": model_name,
             "query_length": len(user_query),
             "response_length": len(response_text),
             "input_tokens": input_tokens,
             "output_tokens": output_tokens,
             "total_tokens": input_tokens + output_tokens,
+            "first_token_time": round(first_token_time, 2) if first_token_time is not None else None,
             "response_time": round(elapsed_time, 2),
             "tokens_per_second": round((input_tokens + output_tokens) / elapsed_time, 2) if elapsed_time > 0 else 0
         }
-        st.session_state.performance_metrics.append(performance_metric)
-        
-        return response_text
+        add_performance_metric(performance_metric)
             
     except ClientError as e:
         # Record error in trace logs
         error_log = {
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "timestamp": timestamp,
             "model_id": model_id,
             "error": str(e),
-            "request": request_body if 'request_body' in locals() else None
+            "request_z": compress_payload(request_body) if 'request_body' in locals() else None
         }
         st.session_state.trace_logs.append(error_log)
+        st.session_state.request_failed = True
         
         st.error(f"Error sending message: {e}")
-        return "I encountered an error processing your request. Please check your AWS credentials and permissions."
+        yield ERROR_RESPONSE
 
 # Initialize Bedrock client
+cred_fingerprint = credential_fingerprint(aws_access_key, aws_secret_key, aws_session_token)
 bedrock_client = get_bedrock_client(
     aws_region,
-    aws_access_key=aws_access_key if aws_access_key else None,
-    aws_secret_key=aws_secret_key if aws_secret_key else None,
-    aws_session_token=aws_session_token if aws_session_token else None
+    cred_fingerprint,
+    _aws_access_key=aws_access_key if aws_access_key else None,
+    _aws_secret_key=aws_secret_key if aws_secret_key else None,
+    _aws_session_token=aws_session_token if aws_session_token else None
 )
 
-# Check model access when model is selected
-if "model_access_checked" not in st.session_state:
-    st.session_state.model_access_checked = {}
-
-if model_id not in st.session_state.model_access_checked and aws_access_key and aws_secret_key:
-    has_access = check_model_access(bedrock_client, model_id)
-    st.session_state.model_access_checked[model_id] = has_access
+# Check access to all models once credentials are provided
+if aws_access_key and aws_secret_key:
+    model_access = check_all_model_access(
+        bedrock_client,
+        aws_region,
+        tuple(model_options.values()),
+        cred_fingerprint
+    )
+    has_access = model_access.get(model_id, True)
     if not has_access:
         st.warning(f"⚠️ You don't have access to {selected_model}. Please enable access in the AWS Bedrock console or select a different model.")
 
+# Function to display the chat history
+# Rendered as a fragment so the history is isolated from the input/append path
+@st.fragment
+def render_history():
+    for message in st.session_state.messages:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+# Function to start a new conversation
+# Runs as a button callback, before the script reruns, so the history is
+# already cleared when it is rendered
+def start_new_conversation():
+    st.session_state.conversation_id = new_conversation_id()
+    st.query_params["conv"] = st.session_state.conversation_id
+    st.session_state.messages = deque(maxlen=HISTORY_WINDOW)
+
+# Latency-optimized inference only applies to supported models and regions
+use_latency_optimized = latency_optimized and model_id in LATENCY_OPTIMIZED_MODELS and aws_region in LATENCY_OPTIMIZED_REGIONS
+
 # Create tabs for chat, metrics, and trace
 chat_tab, metrics_tab, trace_tab = st.tabs(["Chat", "Performance Metrics", "Bedrock Trace"])
 
 with chat_tab:
     # Display chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.write(message["content"])
+    render_history()
 
     # Chat input
     if prompt := st.chat_input("Ask a question..."):
         # Check if credentials are provided
         if not aws_access_key or not aws_secret_key:
             st.error("Please provide your AWS credentials in the sidebar to use this app.")
+        elif queue_mode:
+            # Hold the question until the batch is asked
+            st.session_state.pending_queries.append(prompt)
         else:
-            # Add user message to chat history
-            st.session_state.messages.append({"role": "user", "content": prompt})
-            
             # Display user message
             with st.chat_message("user"):
                 st.write(prompt)
             
-            # Get response from Bedrock
+            # Stream response from Bedrock as tokens arrive
             with st.chat_message("assistant"):
-                with st.spinner(f"{selected_model} is thinking..."):
-                    response = send_message_to_bedrock(
+                response = st.write_stream(
+                    send_message_to_bedrock(
                         bedrock_client,
                         model_id,
-                        st.session_state.messages,
+                        load_messages(st.session_state.conversation_id, MAX_MESSAGES) + [{"role": "user", "content": prompt}],
                         max_tokens,
-                        temperature
+                        temperature,
+                        latency_optimized=use_latency_optimized
                     )
-                    
-                    if response:
-                        st.write(response)
-                        
-                        # Add assistant response to chat history
-                        st.session_state.messages.append({"role": "assistant", "content": response})
-                    else:
-                        st.error("Failed to get response from the model")
+                )
+                
+                if response and not st.session_state.request_failed:
+                    # Record the question and its answer together, so a failed
+                    # request never leaves a question without a reply
+                    add_messages(
+                        {"role": "user", "content": prompt},
+                        {"role": "assistant", "content": response}
+                    )
+                elif not st.session_state.request_failed:
+                    st.error("Failed to get response from the model")
+
+    # Pending queued questions, asked together in one request
+    if st.session_state.pending_queries:
+        st.markdown("**Queued questions:**")
+        st.markdown("\n".join(f"{i}. {query}" for i, query in enumerate(st.session_state.pending_queries, 1)))
+        
+        if st.button("Ask Batch"):
+            queries = st.session_state.pending_queries
+            batch_messages = load_messages(st.session_state.conversation_id, MAX_MESSAGES) + [{"role": "user", "content": build_batch_prompt(queries)}]
+            
+            with st.spinner(f"{selected_model} is answering {len(queries)} questions..."):
+                response = "".join(send_message_to_bedrock(
+                    bedrock_client,
+                    model_id,
+                    batch_messages,
+                    max_tokens,
+                    temperature,
+                    latency_optimized=use_latency_optimized
+                ))
+            
+            # On failure the questions stay queued and the error stays on screen
+            if not st.session_state.request_failed:
+                # Route each answer to its question in the chat history
+                answers = parse_batch_response(response, len(queries))
+                add_messages(*(
+                    message
+                    for i, query in enumerate(queries, 1)
+                    for message in (
+                        {"role": "user", "content": query},
+                        {"role": "assistant", "content": answers.get(i, "No answer was returned for this question.")}
+                    )
+                ))
+                st.session_state.pending_queries = []
+                st.rerun()
 
     # Reset conversation button
-    if st.button("Start New Conversation"):
-        st.session_state.conversation_id = str(uuid.uuid4())
-        st.session_state.messages = []
-        st.rerun()
+    st.button("Start New Conversation", on_click=start_new_conversation)
 
 with metrics_tab:
     st.subheader("Bedrock Performance Metrics")
@@ -378,11 +673,16 @@ with metrics_tab:
         col1, col2 = st.columns([1, 5])
         with col1:
             if st.button("Clear Metrics"):
-                st.session_state.performance_metrics = []
+                st.session_state.performance_metrics = deque(maxlen=log_buffer_size)
+                st.session_state.metrics_version += 1
                 st.rerun()
         
         # Create a DataFrame from the metrics
-        df = pd.DataFrame(st.session_state.performance_metrics)
+        df, means, display_df, token_df = metrics_dataframe(
+            st.session_state.metrics_key,
+            st.session_state.metrics_version,
+            st.session_state.performance_metrics
+        )
         
         # Display summary statistics
         st.subheader("Summary Statistics")
@@ -391,44 +691,30 @@ with metrics_tab:
         with col1:
             st.metric(
                 "Avg Response Time", 
-                f"{df['response_time'].mean():.2f}s",
-                delta=f"{df['response_time'].iloc[-1] - df['response_time'].mean():.2f}s" if len(df) > 1 else None
+                f"{means['response_time']:.2f}s",
+                delta=f"{df['response_time'].iloc[-1] - means['response_time']:.2f}s" if len(df) > 1 else None
             )
         
         with col2:
             st.metric(
                 "Avg Total Tokens", 
-                f"{df['total_tokens'].mean():.0f}",
-                delta=f"{df['total_tokens'].iloc[-1] - df['total_tokens'].mean():.0f}" if len(df) > 1 else None
+                f"{means['total_tokens']:.0f}",
+                delta=f"{df['total_tokens'].iloc[-1] - means['total_tokens']:.0f}" if len(df) > 1 else None
             )
             
         with col3:
             st.metric(
                 "Avg Tokens/Second", 
-                f"{df['tokens_per_second'].mean():.2f}",
-                delta=f"{df['tokens_per_second'].iloc[-1] - df['tokens_per_second'].mean():.2f}" if len(df) > 1 else None
+                f"{means['tokens_per_second']:.2f}",
+                delta=f"{df['tokens_per_second'].iloc[-1] - means['tokens_per_second']:.2f}" if len(df) > 1 else None
             )
         
         # Display metrics table
         st.subheader("Detailed Metrics")
         
-        # Format the DataFrame for display
-        display_df = df.copy()
-        display_df = display_df.sort_values(by='timestamp', ascending=False)
-        
-        # Add model color coding
-        def highlight_model(val):
-            if "Claude" in val:
-                return 'background-color: #e6f3ff'
-            elif "Titan" in val:
-                return 'background-color: #fff2e6'
-            elif "Llama" in val:
-                return 'background-color: #e6ffe6'
-            return ''
-        
-        # Display the styled table
+        # Display the table with model color coding
         st.dataframe(
-            display_df,
+            display_df.style.apply(highlight_models, subset=["model"]),
             column_config={
                 "timestamp": "Time",
                 "model": "Model",
@@ -437,6 +723,7 @@ with metrics_tab:
                 "input_tokens": "Input Tokens",
                 "output_tokens": "Output Tokens",
                 "total_tokens": "Total Tokens",
+                "first_token_time": "Time to First Token (s)",
                 "response_time": "Response Time (s)",
                 "tokens_per_second": "Tokens/Second"
             },
@@ -455,12 +742,6 @@ with metrics_tab:
         if viz_type == "Response Time by Model":
             st.bar_chart(df, x="model", y="response_time")
         elif viz_type == "Token Usage by Model":
-            token_df = df.melt(
-                id_vars=["model", "timestamp"],
-                value_vars=["input_tokens", "output_tokens"],
-                var_name="Token Type",
-                value_name="Token Count"
-            )
             st.bar_chart(token_df, x="model", y="Token Count", color="Token Type")
         else:  # Tokens per Second
             st.bar_chart(df, x="model", y="tokens_per_second")
@@ -473,37 +754,44 @@ with trace_tab:
     else:
         # Add button to clear trace logs
         if st.button("Clear Trace Logs"):
-            st.session_state.trace_logs = []
+            st.session_state.trace_logs = deque(maxlen=log_buffer_size)
             st.rerun()
         
+        # Only the most recent logs are rendered
+        total_logs = len(st.session_state.trace_logs)
+        show_count = st.number_input("Show N most recent traces", min_value=1, max_value=total_logs, value=min(10, total_logs))
+        
         # Display trace logs in reverse order (newest first)
-        for i, log in enumerate(reversed(st.session_state.trace_logs)):
-            with st.expander(f"Trace {len(st.session_state.trace_logs) - i}: {log.get('timestamp', 'Unknown time')} - {log.get('model_id', 'Unknown model')}"):
+        for i, log in enumerate(islice(reversed(st.session_state.trace_logs), show_count)):
+            trace_number = total_logs - i
+            with st.expander(f"Trace {trace_number}: {log.get('timestamp', 'Unknown time')} - {log.get('model_id', 'Unknown model')}", expanded=False):
+                # Expander contents are always sent to the browser, so the
+                # payloads are only rendered on request
+                show_payloads = st.toggle("Show request/response", key=f"trace_payloads_{log.get('timestamp')}_{trace_number}")
                 if "error" in log:
                     st.error(f"Error: {log['error']}")
-                    if log['request']:
+                    if log['request_z'] and show_payloads:
                         st.subheader("Request")
-                        st.json(log['request'])
+                        st.code(decompress_payload(log['request_z']), language="json")
                 else:
-                    st.subheader("Request")
-                    st.json(log['request'])
-                    
-                    st.subheader("Response")
-                    st.json(log['response'])
+                    if show_payloads:
+                        st.subheader("Request")
+                        st.code(decompress_payload(log['request_z']), language="json")
+                        
+                        st.subheader("Response")
+                        st.code(decompress_payload(log['response_z']), language="json")
                     
                     st.subheader("Performance")
+                    if log.get('cache_hit'):
+                        st.write("Served from response cache")
                     st.write(f"Elapsed time: {log['elapsed_time']} seconds")
+                    if log.get('first_token_time') is not None:
+                        st.write(f"Time to first token: {log['first_token_time']} seconds")
                     st.write(f"Parameters: Max tokens = {log['parameters']['max_tokens']}, Temperature = {log['parameters']['temperature']}")
                     
-                    # Calculate token usage if available in the response
-                    if "anthropic" in log['model_id'] and "usage" in log['response']:
-                        usage = log['response']['usage']
-                        st.write(f"Input tokens: {usage.get('input_tokens', 'N/A')}")
-                        st.write(f"Output tokens: {usage.get('output_tokens', 'N/A')}")
-                    elif "amazon" in log['model_id'] and "amazon-bedrock-invocationMetrics" in log['response']:
-                        metrics = log['response']['amazon-bedrock-invocationMetrics']
-                        st.write(f"Input tokens: {metrics.get('inputTokenCount', 'N/A')}")
-                        st.write(f"Output tokens: {metrics.get('outputTokenCount', 'N/A')}")
+                    # Token usage is recorded alongside the compressed payloads
+                    st.write(f"Input tokens: {log.get('input_tokens', 'N/A')}")
+                    st.write(f"Output tokens: {log.get('output_tokens', 'N/A')}")
 
 # Add a note about AWS credentials
 st.sidebar.markdown("---")